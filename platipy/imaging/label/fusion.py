@@ -12,16 +12,45 @@
 # See the License for the specific language governing permissions and
 # limitations under the License.
 
-from functools import reduce
-import warnings
+import importlib.util
+import os
+from concurrent.futures import ThreadPoolExecutor
+from functools import partial
 
 import numpy as np
 import SimpleITK as sitk
 
-from scipy.stats import pearsonr
-from skimage.util.shape import view_as_windows
+from scipy.ndimage import uniform_filter, uniform_filter1d
 from platipy.imaging.registration.utils import smooth_and_resample
 
+# Patches with a variance below this fraction of their mean square value are treated as constant
+# (this is well above the float64 rounding error of the moments, but well below real texture)
+_VARIANCE_TOLERANCE = 1e-11
+
+
+def _bin_indices(arr, bins):
+    """Computes the index of the (equal width) histogram bin each value falls into, spanning the
+    range of the array. Matches the binning of np.histogram when bins is an integer.
+
+    Args:
+        arr (np.ndarray): The array values.
+        bins (int): The number of bins.
+
+    Returns:
+        np.ndarray: The bin indices, in the range [0, bins). These are stored as uint8 when
+            there are 256 bins or fewer.
+    """
+
+    # Work in floating point, the range of an integer array may not fit in its own type
+    lo, hi = float(arr.min()), float(arr.max())
+    scale = bins / (hi - lo) if hi > lo else 0
+
+    arr_scaled = np.subtract(arr, lo, dtype=np.float64)
+    arr_scaled *= scale
+    np.minimum(arr_scaled, bins - 1, out=arr_scaled)
+
+    return arr_scaled.astype(np.uint8 if bins <= 256 else np.int32)
+
 
 def mutual_information(arr_a, arr_b, bins=64):
     """Computes the (histogram-based) mutual information between two arrays
@@ -29,30 +58,348 @@ def mutual_information(arr_a, arr_b, bins=64):
     Args:
         arr_a (np.ndarray): The first image array values, should be flattened to a 1D array.
         arr_b (np.ndarray): The second image array values, should be flattened to a 1D array.
-        bins (np.ndarray | int, optional): Histogram bins. Passed directly to np.histogram2d, so
-            any format accepted by this function is okay. Defaults to 64.
+        bins (np.ndarray | int, optional): Histogram bins. An integer gives this number of equal
+            width bins spanning each array, counted with np.bincount. Otherwise this is passed
+            directly to np.histogram2d, so any format accepted by this function is okay.
+            Defaults to 64.
 
     Returns:
         float: The mutual information between the arrays.
     """
 
-    with warnings.catch_warnings():
-        warnings.simplefilter("ignore")
-
-        p_ab, _, _ = np.histogram2d(arr_a, arr_b, bins=bins, density=True)
+    if isinstance(bins, (int, np.integer)):
+        # Equal width bins, so the joint histogram can be counted in a single pass
+        qa = _bin_indices(arr_a, bins)
+        qb = _bin_indices(arr_b, bins)
+        p_ab = np.bincount(qa.astype(np.intp) * bins + qb, minlength=bins * bins)
+        p_ab = p_ab.reshape(bins, bins)
+        p_ab = p_ab.astype(np.float64)
+    else:
+        p_ab, _, _ = np.histogram2d(arr_a, arr_b, bins=bins)
 
-        p_a = p_ab.sum(axis=0)
-        p_b = p_ab.sum(axis=1)
+    p_ab /= p_ab.sum()
 
-        log_p = np.log(p_ab / np.outer(p_a, p_b))
+    p_a = p_ab.sum(axis=1)
+    p_b = p_ab.sum(axis=0)
 
-    log_p[~np.isfinite(log_p)] = 0
+    # Only non-empty bins contribute, which avoids taking the log of zero
+    ia, ib = np.nonzero(p_ab)
+    pab = p_ab[ia, ib]
 
-    mi = (p_ab * log_p).sum()
+    mi = np.sum(pab * (np.log(pab) - np.log(p_a[ia]) - np.log(p_b[ib])))
 
     return mi
 
 
+def _window_fraction(shape, window, origin, xp=np, filter1d=uniform_filter1d):
+    """Computes the fraction of a box window centred on each voxel which lies within an array.
+
+    This is separable, so is computed along each axis and returned as an array which broadcasts
+    to the array shape. It is one for all windows entirely inside the array, only the windows at
+    the edges differ.
+
+    Args:
+        shape (tuple): The array shape.
+        window (list): The window size (in voxels) along each axis.
+        origin (list): The window origin along each axis, as used by scipy.ndimage filters.
+        xp (module, optional): The array module (NumPy or CuPy). Defaults to np.
+        filter1d (function, optional): The 1D uniform filter matching xp.
+            Defaults to scipy.ndimage.uniform_filter1d.
+
+    Returns:
+        np.ndarray: The fraction of each window inside the array.
+    """
+
+    frac_valid = 1
+    for axis, (n, w, o) in enumerate(zip(shape, window, origin)):
+        frac_axis = filter1d(xp.ones(n, dtype=xp.float64), w, mode="constant", cval=0.0, origin=o)
+        frac_valid = frac_valid * xp.expand_dims(
+            frac_axis, tuple(i for i in range(len(shape)) if i != axis)
+        )
+
+    return frac_valid
+
+
+def _box_mean(image, radius):
+    """Computes the mean in a box around each voxel of an image. This matches sitk.BoxMean (only
+    voxels inside the image are averaged), but runs faster using running sums in NumPy.
+
+    Args:
+        image (SimpleITK.Image): The image.
+        radius (tuple): The box radius (in voxels) along each image axis (x, y, z).
+
+    Returns:
+        SimpleITK.Image: The box mean image (as float32).
+    """
+
+    arr = sitk.GetArrayFromImage(image).astype(np.float32, copy=False)
+    window = [2 * r + 1 for r in radius[::-1]]
+    origin = [0] * arr.ndim
+
+    uniform_filter(arr, window, output=arr, mode="constant", cval=0.0)
+    arr /= _window_fraction(arr.shape, window, origin)
+
+    mean_image = sitk.GetImageFromArray(arr)
+    mean_image.CopyInformation(image)
+
+    return mean_image
+
+
+def _local_correlation(arr_target, arr_moving, window, use_gpu=False):
+    """Computes the Pearson correlation coefficient between two arrays in a patch centred on
+    every voxel, using running (box) sums rather than extracting each patch.
+
+    Voxels beyond the edge of the arrays are excluded, so patches at the edges are computed using
+    only the voxels that are inside the arrays.
+
+    Args:
+        arr_target (np.ndarray): The first image array.
+        arr_moving (np.ndarray): The second image array, the same shape as arr_target.
+        window (list): The patch size (in voxels) along each axis.
+        use_gpu (bool, optional): Compute on the GPU using CuPy (experimental). Defaults to
+            False.
+
+    Raises:
+        ImportError: Raised when use_gpu is set but the CuPy library hasn't been installed.
+
+    Returns:
+        np.ndarray: The correlation coefficient array, the same shape as arr_target.
+    """
+
+    if use_gpu:
+        try:
+            import cupy as xp
+            from cupyx.scipy.ndimage import uniform_filter as xp_uniform_filter
+            from cupyx.scipy.ndimage import uniform_filter1d as xp_uniform_filter1d
+        except ImportError as e:
+            raise ImportError(
+                "CuPy library not found. Be sure to install the CuPy package matching your CUDA "
+                "version to compute the patch correlation on the GPU, e.g. "
+                "'pip install cupy-cuda12x'. See https://docs.cupy.dev/en/stable/install.html"
+            ) from e
+
+        arr_target = xp.asarray(arr_target)
+        arr_moving = xp.asarray(arr_moving)
+    else:
+        xp = np
+        xp_uniform_filter = uniform_filter
+        xp_uniform_filter1d = uniform_filter1d
+
+    # Patches span (i - 1) // 2 voxels before and i // 2 voxels after the centre
+    origin = [(i % 2) - 1 for i in window]
+
+    # The uniform filter is a running sum along each axis, so its cost does not depend on the
+    # window size (and it is no slower than an integral image or FFT for large windows)
+    def box_mean(arr):
+        # SciPy filters can safely write their output over the input. CuPy filters are not
+        # guaranteed to support this, so on the GPU a new output array is allocated
+        output = None if use_gpu else arr
+        return xp_uniform_filter(
+            arr, window, output=output, mode="constant", cval=0.0, origin=origin
+        )
+
+    # Work in float64 buffers, updated in place to avoid volume-sized temporaries
+    # The variances are differences of second moments, so float32 loses low contrast texture
+    # Correlation is unaffected by an offset, removing the mean limits cancellation error
+    arr_target = arr_target.astype(xp.float64)
+    arr_target -= arr_target.mean()
+    arr_moving = arr_moving.astype(xp.float64)
+    arr_moving -= arr_moving.mean()
+
+    # The fraction of each patch which lies within the array
+    frac_valid = _window_fraction(arr_target.shape, window, origin, xp, xp_uniform_filter1d)
+
+    mu_t = box_mean(arr_target.copy())
+    mu_t /= frac_valid
+    mu_m = box_mean(arr_moving.copy())
+    mu_m /= frac_valid
+
+    # Covariance
+    cov = box_mean(xp.multiply(arr_target, arr_moving))
+    cov /= frac_valid
+    cov -= mu_t * mu_m
+
+    # Variances (the image arrays are no longer needed, so are used as the buffers)
+    var_t = box_mean(xp.square(arr_target, out=arr_target))
+    var_t /= frac_valid
+    var_t -= xp.square(mu_t, out=mu_t)
+
+    var_m = box_mean(xp.square(arr_moving, out=arr_moving))
+    var_m /= frac_valid
+    var_m -= xp.square(mu_m, out=mu_m)
+
+    # The variance of a (nearly) constant patch is only cancellation error, so is left undefined
+    # (mu_t and mu_m now hold the squared means, so var + mu is the mean square value)
+    var_t[var_t <= _VARIANCE_TOLERANCE * (var_t + mu_t)] = xp.nan
+    var_m[var_m <= _VARIANCE_TOLERANCE * (var_m + mu_m)] = xp.nan
+
+    # Undefined patches are NaN (errstate only silences the NumPy warnings, CuPy doesn't warn)
+    with np.errstate(divide="ignore", invalid="ignore"):
+        var_t *= var_m
+        corr_arr = xp.divide(cov, xp.sqrt(var_t, out=var_t), out=cov)
+
+    # Rounding can push strongly correlated patches just outside the valid range
+    xp.clip(corr_arr, -1, 1, out=corr_arr)
+
+    if use_gpu:
+        corr_arr = xp.asnumpy(corr_arr)
+
+    return corr_arr
+
+
+_NCC_KERNELS = {}
+
+
+def _make_ncc_kernel(wz, wy, wx):
+    """Compiles (with Numba) a function computing the Pearson correlation coefficient in every
+    patch of padded arrays, for a fixed patch size.
+
+    The patch size is a compile-time constant of the kernel, so the patch loops can be unrolled
+    and vectorised. Kernels are cached by patch size, since this rarely changes.
+
+    Args:
+        wz (int): The patch size along the first axis.
+        wy (int): The patch size along the second axis.
+        wx (int): The patch size along the third axis.
+
+    Returns:
+        function: The compiled kernel, called as kernel(arr_t, arr_m, arr_mask, out).
+    """
+
+    if (wz, wy, wx) in _NCC_KERNELS:
+        return _NCC_KERNELS[(wz, wy, wx)]
+
+    from numba import njit, prange
+
+    tolerance = _VARIANCE_TOLERANCE
+
+    # The centre of each patch, relative to its start in the padded arrays
+    cz, cy, cx = (wz - 1) // 2, (wy - 1) // 2, (wx - 1) // 2
+
+    def ncc_kernel(arr_t, arr_m, arr_mask, out):
+        """Computes the Pearson correlation coefficient in every patch of the padded arrays,
+        skipping masked voxels.
+
+        Args:
+            arr_t (np.ndarray): The (padded) first image array.
+            arr_m (np.ndarray): The (padded) second image array.
+            arr_mask (np.ndarray): The (padded) boolean mask array, False voxels are skipped.
+            out (np.ndarray): The output array, patches are taken from the padded arrays
+                starting at each index of this array.
+        """
+
+        for z in prange(out.shape[0]):
+            for y in range(out.shape[1]):
+                for x in range(out.shape[2]):
+                    # Sums are taken relative to the centre voxel, which limits cancellation
+                    # error when the patch is on a large intensity offset
+                    ref_t = np.float64(arr_t[z + cz, y + cy, x + cx])
+                    ref_m = np.float64(arr_m[z + cz, y + cy, x + cx])
+
+                    sum_t = 0.0
+                    sum_m = 0.0
+                    sum_tt = 0.0
+                    sum_mm = 0.0
+                    sum_tm = 0.0
+                    n = 0
+
+                    for k in range(wz):
+                        for j in range(wy):
+                            for i in range(wx):
+                                if not arr_mask[z + k, y + j, x + i]:
+                                    continue
+
+                                t = np.float64(arr_t[z + k, y + j, x + i]) - ref_t
+                                m = np.float64(arr_m[z + k, y + j, x + i]) - ref_m
+
+                                sum_t += t
+                                sum_m += m
+                                sum_tt += t * t
+                                sum_mm += m * m
+                                sum_tm += t * m
+                                n += 1
+
+                    var_t = n * sum_tt - sum_t**2
+                    var_m = n * sum_mm - sum_m**2
+
+                    # Constant patches are undefined, matching _local_correlation
+                    if var_t <= tolerance * n * sum_tt or var_m <= tolerance * n * sum_mm:
+                        out[z, y, x] = np.nan
+                    else:
+                        corr = (n * sum_tm - sum_t * sum_m) / np.sqrt(var_t * var_m)
+                        out[z, y, x] = min(max(corr, -1.0), 1.0)
+
+    _NCC_KERNELS[(wz, wy, wx)] = njit(parallel=True, fastmath=True)(ncc_kernel)
+
+    return _NCC_KERNELS[(wz, wy, wx)]
+
+
+def _local_correlation_numba(arr_target, arr_moving, window):
+    """Computes the Pearson correlation coefficient between two arrays in a patch centred on
+    every voxel, looping over the patches in parallel with Numba.
+
+    This gives the same result as _local_correlation, but avoids the volume-sized intermediate
+    arrays.
+
+    Args:
+        arr_target (np.ndarray): The first image array.
+        arr_moving (np.ndarray): The second image array, the same shape as arr_target.
+        window (list): The patch size (in voxels) along each axis.
+
+    Raises:
+        ImportError: Raised when the Numba library hasn't been installed.
+
+    Returns:
+        np.ndarray: The correlation coefficient array, the same shape as arr_target.
+    """
+
+    if importlib.util.find_spec("numba") is None:
+        raise ImportError(
+            "Numba library not found. Be sure to install it to compute the patch correlation "
+            "using Numba: 'pip install platipy[numba]'"
+        )
+
+    corr_arr = np.empty(arr_target.shape, dtype=np.float64)
+
+    # The mask will help us deal with zero data at the edges (generated by padding)
+    arr_mask = np.ones_like(arr_target, dtype=bool)
+
+    # Pad the arrays
+    padder = [((i - 1) // 2, (i) // 2) for i in window]
+    arr_target = np.pad(arr_target, padder)
+    arr_moving = np.pad(arr_moving, padder)
+    arr_mask = np.pad(arr_mask, padder)
+
+    ncc_kernel = _make_ncc_kernel(*window)
+    ncc_kernel(arr_target, arr_moving, arr_mask, corr_arr)
+
+    return corr_arr
+
+
+def _normalise_weight_map(weight_map, normalise):
+    """Normalises a weight map by its maximum value.
+
+    Args:
+        weight_map (SimpleITK.Image): The weight map.
+        normalise (bool | SimpleITK.Image): If True, the weight map is divided by its maximum. If
+            a mask image, the weight map is divided by its maximum within the mask.
+
+    Returns:
+        SimpleITK.Image: The (normalised) weight map.
+    """
+
+    if isinstance(normalise, bool):
+        if normalise:
+            weight_map = weight_map / sitk.GetArrayViewFromImage(weight_map).max()
+    if isinstance(normalise, sitk.Image):
+        # Reduce over the views directly, rather than masking the weight map image
+        weight_arr = sitk.GetArrayViewFromImage(weight_map)
+        mask_arr = sitk.GetArrayViewFromImage(normalise)
+        weight_map = weight_map / float(np.max(weight_arr, where=mask_arr != 0, initial=0))
+
+    return weight_map
+
+
 def compute_weight_map(
     target_image,
     moving_image,
@@ -67,10 +414,33 @@ def compute_weight_map(
         "patch_window_mm": 25,
         "resampled_voxel_size_mm": 3,
         "correlation_function": lambda x: x + 1,
+        "use_numba": False,
+        "use_gpu": False,
     },
 ):
-    """
-    Computes the weight map
+    """Computes the weight map, used to weight the votes of a moving (atlas) image when combining
+    labels.
+
+    Args:
+        target_image (SimpleITK.Image): The target image.
+        moving_image (SimpleITK.Image): The moving (atlas) image, registered to the target image.
+        vote_type (str, optional): The weighting method, one of "unweighted", "global", "local",
+            "block" or "patch_correlation". Defaults to "unweighted".
+        vote_params (dict, optional): The weighting parameters. Only those used by the vote
+            type are required:
+            - "sigma", "epsilon", "normalise": used by "local" weighting
+            - "factor", "gain", "blockSize", "normalise": used by "block" weighting
+            - "factor": used by "global" weighting
+            - "patch_window_mm", "resampled_voxel_size_mm", "correlation_function": used by
+              "patch_correlation" weighting
+            - "use_numba" (optional): compute the patch correlation with Numba, which uses less
+              memory. Requires 'pip install platipy[numba]'.
+            - "use_gpu" (optional, experimental): compute the patch correlation on the GPU
+              with CuPy. Requires the CuPy package matching your CUDA version, e.g.
+              'pip install cupy-cuda12x'.
+
+    Returns:
+        SimpleITK.Image: The weight map (as float32).
     """
 
     # Cast to floating point representation, if necessary
@@ -90,46 +460,19 @@ def compute_weight_map(
         # Convert to arrats
         arr_target = sitk.GetArrayFromImage(img_target_res)
         arr_moving = sitk.GetArrayFromImage(img_moving_res)
-        # The mask will help us deal with zero data at the edges (generated by padding)
-        arr_mask = 0 * arr_target + 1
 
         # Define the patch box in image coordinates
         window_box_mm = vote_params["patch_window_mm"]
         window_box_im = [int(window_box_mm / i) for i in img_target_res.GetSpacing()[::-1]]
 
-        # Pad the arrays
-        padder = [((i - 1) // 2, (i) // 2) for i in window_box_im]  # Could pad more at other ends?
-        arr_target = np.pad(arr_target, padder)
-        arr_moving = np.pad(arr_moving, padder)
-        arr_mask = np.pad(arr_mask, padder)
-
-        # Extract the patches as views
-        view_target = view_as_windows(arr_target, window_box_im)
-        view_moving = view_as_windows(arr_moving, window_box_im)
-        view_mask = view_as_windows(arr_mask, window_box_im)
-
-        # Flatten to have a list of patches (that are also flattened)
-        new_shape = (np.prod(view_target.shape[:3]), np.prod(view_target.shape[3:]))
-        view_target_flat = np.reshape(view_target, new_shape)
-        view_moving_flat = np.reshape(view_moving, new_shape)
-        view_mask_flat = np.reshape(view_mask, new_shape)
-
-        # Iterate over patches
-        corr_values = []
-        for i in range(view_target_flat.shape[0]):
-
-            patch_mask = view_mask_flat[i]
-
-            patch_target = view_target_flat[i, :][np.where(patch_mask)]
-            patch_moving = view_moving_flat[i, :][np.where(patch_mask)]
-
-            # Calculate Pearson correlation coefficient
-            sr, _ = pearsonr(patch_target, patch_moving)
-            corr_values.append(sr)
-
-        # Reshape into the image
-        corr_arr = np.reshape(corr_values, img_target_res.GetSize()[::-1])
-        corr_arr[np.isnan(corr_arr)] = 0
+        # Compute the Pearson correlation coefficient in every patch
+        if vote_params.get("use_numba", False):
+            corr_arr = _local_correlation_numba(arr_target, arr_moving, window_box_im)
+        else:
+            corr_arr = _local_correlation(
+                arr_target, arr_moving, window_box_im, use_gpu=vote_params.get("use_gpu", False)
+            )
+        corr_arr[~np.isfinite(corr_arr)] = 0
 
         # Copy information
         corr_img = sitk.GetImageFromArray(corr_arr)
@@ -153,8 +496,8 @@ def compute_weight_map(
 
     elif vote_type.lower() == "global":
         factor = vote_params["factor"]
-        sum_squared_difference = sitk.GetArrayFromImage(square_difference_image).sum(
-            dtype=np.float
+        sum_squared_difference = sitk.GetArrayViewFromImage(square_difference_image).sum(
+            dtype=np.float64
         )
         global_weight = factor / sum_squared_difference
 
@@ -168,13 +511,7 @@ def compute_weight_map(
         raw_map = sitk.DiscreteGaussian(square_difference_image, sigma * sigma)
         weight_map = sitk.Pow(raw_map + epsilon, -1.0)
 
-        if isinstance(normalise, bool):
-            if normalise:
-                weight_map = weight_map / sitk.GetArrayViewFromImage(weight_map).max()
-        if isinstance(normalise, sitk.Image):
-            weight_map = (
-                weight_map / sitk.GetArrayViewFromImage(sitk.Mask(weight_map, normalise)).max()
-            )
+        weight_map = _normalise_weight_map(weight_map, normalise)
 
     elif vote_type.lower() == "block":
         factor = vote_params["factor"]
@@ -186,54 +523,105 @@ def compute_weight_map(
             block_size = (block_size,) * target_image.GetDimension()
 
         # rawMap = sitk.Mean(square_difference_image, blockSize)
-        raw_map = sitk.BoxMean(square_difference_image, block_size)
+        raw_map = _box_mean(square_difference_image, block_size)
         weight_map = factor * sitk.Pow(raw_map, -1.0) ** abs(gain / 2.0)
         # Note: we divide gain by 2 to account for using the squared difference image
         #       which raises the power by 2 already.
 
-        if isinstance(normalise, bool):
-            if normalise:
-                weight_map = weight_map / sitk.GetArrayViewFromImage(weight_map).max()
-        if isinstance(normalise, sitk.Image):
-            weight_map = (
-                weight_map / sitk.GetArrayViewFromImage(sitk.Mask(weight_map, normalise)).max()
-            )
+        weight_map = _normalise_weight_map(weight_map, normalise)
 
     return sitk.Cast(weight_map, sitk.sitkFloat32)
 
 
-def combine_labels_staple(label_list_dict, threshold=1e-4):
+def _staple_structure(label_list_dict, structure_name, threshold, number_of_threads=None):
     """
-    Combine labels using STAPLE
+    Combine the labels of a single structure using STAPLE
     """
 
-    combined_label_dict = {}
+    # Ensure all labels are binarised
+    # This is done in NumPy since sitk.BinaryThreshold casts the threshold to the pixel type,
+    # which would binarise integer labels at zero (i.e. every voxel would be foreground)
+    binary_labels = []
+    for i in label_list_dict:
+        label = label_list_dict[i][structure_name]
+        binary_label = sitk.GetImageFromArray(
+            (sitk.GetArrayViewFromImage(label) >= 0.5).astype(np.uint8)
+        )
+        binary_label.CopyInformation(label)
+        binary_labels.append(binary_label)
 
-    structure_name_list = [list(i.keys()) for i in label_list_dict.values()]
-    structure_name_list = np.unique([item for sublist in structure_name_list for item in sublist])
+    # Perform STAPLE
+    staple_filter = sitk.STAPLEImageFilter()
+    if number_of_threads:
+        staple_filter.SetNumberOfThreads(number_of_threads)
+    staple_image = staple_filter.Execute(binary_labels)
 
-    for structure_name in structure_name_list:
-        # Ensure all labels are binarised
-        binary_labels = [
-            sitk.BinaryThreshold(label_list_dict[i][structure_name], lowerThreshold=0.5)
-            for i in label_list_dict
-        ]
+    # Normalise (to [0, 1], in a single pass over the array)
+    arr = sitk.GetArrayFromImage(staple_image)
+    arr -= arr.min()
+    arr_max = arr.max()
+    if arr_max > 0:
+        arr /= arr_max
 
-        # Perform STAPLE
-        combined_label = sitk.STAPLE(binary_labels)
+    # Threshold - grants vastly improved compression performance
+    if threshold:
+        arr[arr < threshold] = 0.0
 
-        # Normalise
-        combined_label = sitk.RescaleIntensity(combined_label, 0, 1)
+    combined_label = sitk.GetImageFromArray(arr)
+    combined_label.CopyInformation(staple_image)
 
-        # Threshold - grants vastly improved compression performance
-        if threshold:
-            combined_label = sitk.Threshold(
-                combined_label, lower=threshold, upper=1, outsideValue=0.0
-            )
+    return combined_label
 
-        combined_label_dict[structure_name] = combined_label
 
-    return combined_label_dict
+def combine_labels_staple(label_list_dict, threshold=1e-4, n_jobs=1):
+    """Combine labels using STAPLE
+
+    Args:
+        label_list_dict (dict): Dictionary of labels for each case, where each value is a
+            dictionary of labels (SimpleITK.Image) keyed by structure name.
+        threshold (float, optional): Values of the combined labels below this are set to zero.
+            Defaults to 1e-4.
+        n_jobs (int, optional): The number of structures to combine in parallel (in separate
+            threads). Use -1 for the number of CPUs. STAPLE is itself multithreaded by ITK
+            (using sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() threads), so when
+            running in parallel these threads are shared between the jobs. Defaults to 1.
+
+    Raises:
+        ValueError: Raised when n_jobs is not a positive integer or -1.
+
+    Returns:
+        dict: The combined label (SimpleITK.Image) for each structure.
+    """
+
+    if n_jobs == 0 or n_jobs < -1:
+        raise ValueError(f"n_jobs must be a positive integer or -1, not {n_jobs}")
+
+    structure_name_list = [list(i.keys()) for i in label_list_dict.values()]
+    structure_name_list = np.unique([item for sublist in structure_name_list for item in sublist])
+
+    # os.cpu_count() returns None when the number of CPUs can't be determined
+    max_workers = (os.cpu_count() or 1) if n_jobs == -1 else n_jobs
+    max_workers = min(max_workers, len(structure_name_list))
+
+    if max_workers <= 1:
+        staple_structure = partial(_staple_structure, label_list_dict, threshold=threshold)
+        combined_label_list = map(staple_structure, structure_name_list)
+    else:
+        # SimpleITK releases the GIL while filters execute, so threads run STAPLE in parallel
+        # Split the ITK threads between the jobs, rather than oversubscribing the CPUs
+        number_of_threads = max(
+            1, sitk.ProcessObject.GetGlobalDefaultNumberOfThreads() // max_workers
+        )
+        staple_structure = partial(
+            _staple_structure,
+            label_list_dict,
+            threshold=threshold,
+            number_of_threads=number_of_threads,
+        )
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            combined_label_list = list(executor.map(staple_structure, structure_name_list))
+
+    return dict(zip(structure_name_list, combined_label_list))
 
 
 def combine_labels(atlas_set, structure_name, label="DIR", threshold=1e-4, smooth_sigma=1.0):
@@ -250,30 +638,49 @@ def combine_labels(atlas_set, structure_name, label="DIR", threshold=1e-4, smoot
 
     combined_label_dict = {}
 
+    # The weight maps are shared by all structures, so are only fetched once
+    weight_arr_dict = {
+        case_id: sitk.GetArrayViewFromImage(atlas_set[case_id][label]["Weight Map"])
+        for case_id in case_id_list
+        if "Weight Map" in atlas_set[case_id][label]
+    }
+
+    # The sum of the weights only depends on which cases have the structure
+    weight_sum_dict = {}
+
     for s_name in structure_name_list:
         # Find the cases which have the strucure (in case some cases do not)
         valid_case_id_list = [i for i in case_id_list if s_name in atlas_set[i][label].keys()]
 
-        # Get valid weight images
-        weight_image_list = [
-            atlas_set[caseId][label]["Weight Map"] for caseId in valid_case_id_list
-        ]
+        reference_image = atlas_set[valid_case_id_list[0]][label]["Weight Map"]
+        shape = reference_image.GetSize()[::-1]
 
-        # Sum the weight images
-        weight_sum_image = reduce(lambda x, y: x + y, weight_image_list)
-        weight_sum_image = sitk.Mask(
-            weight_sum_image, weight_sum_image == 0, maskingValue=1, outsideValue=1
-        )
+        # Sum the weights (once for each set of cases)
+        case_id_key = tuple(valid_case_id_list)
+        if case_id_key not in weight_sum_dict:
+            weight_sum = np.zeros(shape, dtype=np.float32)
+            for case_id in valid_case_id_list:
+                weight_sum += weight_arr_dict[case_id]
+            weight_sum[weight_sum == 0] = 1
+            weight_sum_dict[case_id_key] = weight_sum
 
-        # Combine weight map with each label
-        weighted_labels = [
-            atlas_set[caseId][label]["Weight Map"]
-            * sitk.Cast(atlas_set[caseId][label][s_name], sitk.sitkFloat32)
-            for caseId in valid_case_id_list
-        ]
+        weight_sum = weight_sum_dict[case_id_key]
+
+        # Accumulate the weighted labels
+        weighted_label_sum = np.zeros(shape, dtype=np.float32)
+        weighted_label = np.empty(shape, dtype=np.float32)
+
+        for case_id in valid_case_id_list:
+            label_arr = sitk.GetArrayViewFromImage(atlas_set[case_id][label][s_name])
+
+            np.multiply(weight_arr_dict[case_id], label_arr, out=weighted_label, casting="unsafe")
+            weighted_label_sum += weighted_label
 
         # Combine all the weighted labels
-        combined_label = reduce(lambda x, y: x + y, weighted_labels) / weight_sum_image
+        weighted_label_sum /= weight_sum
+
+        combined_label = sitk.GetImageFromArray(weighted_label_sum)
+        combined_label.CopyInformation(reference_image)
 
         # Smooth combined label
         combined_label = sitk.DiscreteGaussian(combined_label, smooth_sigma * smooth_sigma)
@@ -313,16 +720,16 @@ def process_probability_image(probability_image, threshold=0.5):
     # Apply the connected component filter
     labelled_image = sitk.ConnectedComponent(binary_image)
 
-    # Measure the size of each connected component
-    label_shape_filter = sitk.LabelShapeStatisticsImageFilter()
-    label_shape_filter.Execute(labelled_image)
-    label_indices = label_shape_filter.GetLabels()
-    voxel_counts = [label_shape_filter.GetNumberOfPixels(i) for i in label_indices]
-    if voxel_counts == []:
+    # Measure the size of each connected component (ignoring the background)
+    labelled_arr = sitk.GetArrayViewFromImage(labelled_image)
+    voxel_counts = np.bincount(labelled_arr.ravel())
+    voxel_counts[0] = 0
+    if not voxel_counts.any():
         return binary_image
 
     # Select the largest region
-    largest_component_label = label_indices[np.argmax(voxel_counts)]
-    largest_component_image = labelled_image == largest_component_label
+    largest_component_arr = (labelled_arr == voxel_counts.argmax()).astype(np.uint8)
+    largest_component_image = sitk.GetImageFromArray(largest_component_arr)
+    largest_component_image.CopyInformation(labelled_image)
 
-    return sitk.Cast(largest_component_image, sitk.sitkUInt8)
+    return largest_component_image
@@ -645,7 +645,7 @@ def run_cardiac_segmentation(img, guide_structure=None, settings=CARDIAC_SETTING
 
             del reg_image
 
-        combined_image = sum(registered_crop_images) / len(registered_crop_images) > -1000
+        combined_image = sitk.NaryAdd(registered_crop_images) / len(registered_crop_images) > -1000
 
         crop_box_size, crop_box_index = label_to_roi(combined_image, expansion_mm=expansion_mm)
 
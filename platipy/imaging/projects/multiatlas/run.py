@@ -236,7 +236,7 @@ def run_segmentation(img, settings=MUTLIATLAS_SETTINGS_DEFAULTS):
 
         del reg_image
 
-    combined_image = sum(registered_crop_images) / len(registered_crop_images) > -1000
+    combined_image = sitk.NaryAdd(registered_crop_images) / len(registered_crop_images) > -1000
 
     crop_box_size, crop_box_index = label_to_roi(combined_image, expansion_mm=expansion_mm)
 
@@ -0,0 +1,412 @@
+import warnings
+
+import SimpleITK as sitk
+import numpy as np
+import pytest
+
+from scipy.stats import pearsonr
+
+from platipy.imaging.label.fusion import (
+    _box_mean,
+    _local_correlation,
+    _local_correlation_numba,
+    _normalise_weight_map,
+    combine_labels_staple,
+    compute_weight_map,
+    mutual_information,
+)
+
+
+def reference_local_correlation(arr_a, arr_b, window):
+    """Pearson correlation coefficient in a patch centred on each voxel, patches at the edges only
+    include the voxels inside the arrays. Constant patches are undefined (NaN)."""
+
+    corr_arr = np.zeros(arr_a.shape)
+
+    for index in np.ndindex(arr_a.shape):
+        patch = tuple(
+            slice(max(i - (w - 1) // 2, 0), i + w // 2 + 1) for i, w in zip(index, window)
+        )
+        patch_a = arr_a[patch].ravel().astype(np.float64)
+        patch_b = arr_b[patch].ravel().astype(np.float64)
+
+        if np.ptp(patch_a) == 0 or np.ptp(patch_b) == 0:
+            corr_arr[index] = np.nan
+        else:
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore")
+                corr_arr[index] = pearsonr(patch_a, patch_b)[0]
+
+    return corr_arr
+
+
+def reference_mutual_information(arr_a, arr_b, bins):
+
+    p_ab, _, _ = np.histogram2d(arr_a, arr_b, bins=bins)
+    p_ab /= p_ab.sum()
+
+    p_a = p_ab.sum(axis=1, keepdims=True)
+    p_b = p_ab.sum(axis=0, keepdims=True)
+
+    nonzero = p_ab > 0
+
+    return np.sum(p_ab[nonzero] * np.log(p_ab[nonzero] / (p_a * p_b)[nonzero]))
+
+
+def make_test_arrays(shape, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    arr_a = rng.normal(0, 100, shape).astype(np.float32)
+    arr_b = (0.5 * arr_a + rng.normal(0, 100, shape)).astype(np.float32)
+
+    return arr_a, arr_b
+
+
+def make_low_contrast_arrays(shape, offsets, std, seed=0):
+    """Strongly correlated (r ~ 0.99) low contrast texture, on a large intensity offset in each
+    half of the arrays (e.g. air and soft tissue in CT)."""
+
+    rng = np.random.default_rng(seed)
+
+    texture = rng.normal(0, std, shape)
+    arr_a = texture + rng.normal(0, std / 8, shape)
+    arr_b = texture + rng.normal(0, std / 8, shape)
+
+    offset = np.full(shape, offsets[1], dtype=np.float64)
+    offset[: shape[0] // 2] = offsets[0]
+
+    return (arr_a + offset).astype(np.float32), (arr_b + offset).astype(np.float32)
+
+
+@pytest.mark.parametrize("window", [(3, 3, 3), (5, 3, 7), (4, 4, 4), (2, 5, 6)])
+def test_local_correlation(window):
+
+    arr_a, arr_b = make_test_arrays((12, 13, 14))
+
+    corr_arr = _local_correlation(arr_a, arr_b, window)
+    corr_ref = reference_local_correlation(arr_a, arr_b, window)
+
+    assert corr_arr.shape == arr_a.shape
+    assert np.allclose(corr_arr, corr_ref, atol=1e-4)
+
+
+@pytest.mark.parametrize("window", [(5, 5, 5), (4, 4, 4)])
+def test_local_correlation_constant_region(window):
+
+    arr_a, arr_b = make_test_arrays((20, 20, 20))
+    arr_a[:10] = -1000
+    arr_b[:10] = -1000
+
+    corr_arr = _local_correlation(arr_a, arr_b, window)
+    corr_ref = reference_local_correlation(arr_a, arr_b, window)
+
+    # Patches entirely within the constant region are undefined
+    assert np.isnan(corr_ref[:8]).all()
+    assert np.isnan(corr_arr[:8]).all()
+
+    assert np.allclose(corr_arr, corr_ref, atol=1e-4, equal_nan=True)
+    assert np.nanmax(np.abs(corr_arr)) <= 1
+
+
+@pytest.mark.parametrize(
+    "offsets, std", [((-1000, 40), 1), ((-1000, 40), 2), ((1024, 1024), 2), ((3000, 3000), 5)]
+)
+def test_local_correlation_low_contrast(offsets, std):
+
+    arr_a, arr_b = make_low_contrast_arrays((16, 20, 20), offsets, std)
+    window = (5, 5, 5)
+
+    corr_arr = _local_correlation(arr_a, arr_b, window)
+    corr_ref = reference_local_correlation(arr_a, arr_b, window)
+
+    # The texture is real signal, so no patches are undefined
+    assert not np.isnan(corr_arr).any()
+    assert np.allclose(corr_arr, corr_ref, atol=1e-4)
+
+
+@pytest.mark.parametrize("window", [(5, 5, 5), (4, 3, 6)])
+def test_local_correlation_numba(window):
+
+    pytest.importorskip("numba")
+
+    arr_a, arr_b = make_test_arrays((20, 20, 20))
+    arr_a[:10] = -1000
+    arr_b[:10] = -1000
+
+    corr_arr = _local_correlation_numba(arr_a, arr_b, window)
+    corr_ref = reference_local_correlation(arr_a, arr_b, window)
+
+    assert np.allclose(corr_arr, corr_ref, atol=1e-4, equal_nan=True)
+
+
+@pytest.mark.parametrize(
+    "offsets, std", [((-1000, 40), 1), ((1024, 1024), 2), ((3000, 3000), 5), ((1e6, 1e6), 1)]
+)
+def test_local_correlation_numba_low_contrast(offsets, std):
+
+    pytest.importorskip("numba")
+
+    arr_a, arr_b = make_low_contrast_arrays((16, 20, 20), offsets, std)
+    window = (5, 5, 5)
+
+    corr_arr = _local_correlation_numba(arr_a, arr_b, window)
+    corr_ref = reference_local_correlation(arr_a, arr_b, window)
+
+    # The texture is real signal, so no patches are undefined
+    assert not np.isnan(corr_arr).any()
+    assert np.allclose(corr_arr, corr_ref, atol=1e-4)
+    assert np.allclose(corr_arr, _local_correlation(arr_a, arr_b, window), atol=1e-4)
+
+
+@pytest.mark.parametrize("window", [(5, 5, 5), (4, 3, 6)])
+def test_local_correlation_gpu(window):
+
+    pytest.importorskip("cupy")
+
+    arr_a, arr_b = make_test_arrays((20, 20, 20))
+    arr_a[:10] = -1000
+    arr_b[:10] = -1000
+
+    corr_arr = _local_correlation(arr_a, arr_b, window, use_gpu=True)
+    corr_cpu = _local_correlation(arr_a, arr_b, window)
+
+    assert isinstance(corr_arr, np.ndarray)
+    assert np.allclose(corr_arr, corr_cpu, atol=1e-4, equal_nan=True)
+
+
+def test_compute_weight_map_patch_correlation_constant_region():
+
+    arr_a, arr_b = make_test_arrays((20, 20, 20))
+    arr_a[:10] = -1000
+    arr_b[:10] = -1000
+
+    weight_map = compute_weight_map(
+        sitk.GetImageFromArray(arr_a),
+        sitk.GetImageFromArray(arr_b),
+        vote_type="patch_correlation",
+        vote_params={
+            "patch_window_mm": 5,
+            "resampled_voxel_size_mm": 1,
+            "correlation_function": lambda x: x + 1,
+        },
+    )
+    weight_arr = sitk.GetArrayFromImage(weight_map)
+
+    # Undefined (constant) patches have zero correlation
+    assert np.all(weight_arr[:8] == 1)
+    assert np.all((weight_arr >= 0) & (weight_arr <= 2))
+
+
+@pytest.mark.parametrize(
+    "shape, radius",
+    [
+        ((13, 17, 11), (1, 1, 1)),
+        ((13, 17, 11), (2, 1, 3)),
+        ((9, 10, 21), (0, 4, 2)),
+        ((5, 6, 7), (8, 2, 5)),
+        ((15, 22), (3, 1)),
+    ],
+)
+def test_box_mean(shape, radius):
+
+    rng = np.random.default_rng(0)
+    image = sitk.GetImageFromArray(rng.uniform(0, 100, shape).astype(np.float32))
+
+    mean_arr = sitk.GetArrayFromImage(_box_mean(image, radius))
+    mean_ref = sitk.GetArrayFromImage(sitk.BoxMean(image, radius))
+
+    assert mean_arr.shape == shape
+    assert np.allclose(mean_arr, mean_ref, rtol=1e-5)
+
+
+@pytest.mark.parametrize("vote_type", ["local", "block"])
+def test_compute_weight_map_normalise_mask(vote_type):
+
+    arr_a, arr_b = make_test_arrays((20, 20, 20))
+    image_a, image_b = sitk.GetImageFromArray(arr_a), sitk.GetImageFromArray(arr_b)
+
+    mask_arr = np.zeros(arr_a.shape, dtype=np.uint8)
+    mask_arr[5:12, 8:15, 3:9] = 1
+    mask = sitk.GetImageFromArray(mask_arr)
+
+    vote_params = {
+        "sigma": 2.0,
+        "epsilon": 1e-5,
+        "factor": 1e12,
+        "gain": 6,
+        "blockSize": 3,
+        "normalise": False,
+    }
+
+    weight_arr = sitk.GetArrayFromImage(
+        compute_weight_map(image_a, image_b, vote_type=vote_type, vote_params=vote_params)
+    )
+    weight_arr_normalised = sitk.GetArrayFromImage(
+        compute_weight_map(
+            image_a, image_b, vote_type=vote_type, vote_params={**vote_params, "normalise": mask}
+        )
+    )
+
+    assert np.allclose(weight_arr_normalised, weight_arr / weight_arr[mask_arr != 0].max())
+    assert np.isclose(weight_arr_normalised[mask_arr != 0].max(), 1)
+
+
+def test_normalise_weight_map():
+
+    rng = np.random.default_rng(0)
+    weight_arr = rng.uniform(0, 10, (12, 13, 14)).astype(np.float32)
+    weight_map = sitk.GetImageFromArray(weight_arr)
+
+    mask_arr = (rng.uniform(0, 1, weight_arr.shape) > 0.7).astype(np.uint8)
+    mask = sitk.GetImageFromArray(mask_arr)
+
+    normalised_arr = sitk.GetArrayFromImage(_normalise_weight_map(weight_map, mask))
+    assert np.allclose(normalised_arr, weight_arr / weight_arr[mask_arr != 0].max())
+
+    normalised_arr = sitk.GetArrayFromImage(_normalise_weight_map(weight_map, True))
+    assert np.allclose(normalised_arr, weight_arr / weight_arr.max())
+
+    normalised_arr = sitk.GetArrayFromImage(_normalise_weight_map(weight_map, False))
+    assert np.array_equal(normalised_arr, weight_arr)
+
+
+def make_test_labels(shape, n_cases=4, seed=0):
+
+    rng = np.random.default_rng(seed)
+
+    label_list_dict = {}
+    for case_id in range(n_cases):
+        label_list_dict[case_id] = {}
+        for structure_name, centre in [("A", 0.4), ("B", 0.6)]:
+            # Spheres with a randomly perturbed centre and radius
+            grid = np.indices(shape) / np.array(shape)[:, None, None, None]
+            dist = np.linalg.norm(grid - (centre + rng.normal(0, 0.03, (3, 1, 1, 1))), axis=0)
+            label_arr = (dist < 0.2 + rng.normal(0, 0.02)).astype(np.uint8)
+            label_list_dict[case_id][structure_name] = sitk.GetImageFromArray(label_arr)
+
+    return label_list_dict
+
+
+def reference_combine_labels_staple(label_list_dict, threshold=1e-4):
+    """STAPLE using SimpleITK filters, on float32 labels (so these are binarised at 0.5)"""
+
+    structure_name_list = np.unique([s for i in label_list_dict.values() for s in i])
+
+    combined_label_dict = {}
+    for structure_name in structure_name_list:
+        binary_labels = [
+            sitk.BinaryThreshold(
+                sitk.Cast(label_list_dict[i][structure_name], sitk.sitkFloat32),
+                lowerThreshold=0.5,
+            )
+            for i in label_list_dict
+        ]
+
+        combined_label = sitk.STAPLE(binary_labels)
+        combined_label = sitk.RescaleIntensity(combined_label, 0, 1)
+        combined_label = sitk.Threshold(combined_label, lower=threshold, upper=1, outsideValue=0)
+
+        combined_label_dict[structure_name] = combined_label
+
+    return combined_label_dict
+
+
+def test_combine_labels_staple_label_type():
+
+    label_list_dict = make_test_labels((20, 24, 22))
+    label_list_dict_float = {
+        case_id: {s: sitk.Cast(label, sitk.sitkFloat32) for s, label in labels.items()}
+        for case_id, labels in label_list_dict.items()
+    }
+
+    combined = combine_labels_staple(label_list_dict)
+    combined_float = combine_labels_staple(label_list_dict_float)
+    combined_ref = reference_combine_labels_staple(label_list_dict)
+
+    assert combined.keys() == combined_ref.keys()
+    for structure_name, combined_label in combined.items():
+        combined_arr = sitk.GetArrayFromImage(combined_label)
+
+        assert 0 < combined_arr.mean() < 1
+        assert np.array_equal(combined_arr, sitk.GetArrayFromImage(combined_float[structure_name]))
+        assert np.allclose(
+            combined_arr, sitk.GetArrayFromImage(combined_ref[structure_name]), atol=1e-6
+        )
+
+
+@pytest.mark.parametrize("n_jobs", [-1, 2])
+def test_combine_labels_staple_n_jobs(n_jobs):
+
+    label_list_dict = make_test_labels((20, 24, 22))
+
+    combined = combine_labels_staple(label_list_dict, n_jobs=1)
+    combined_parallel = combine_labels_staple(label_list_dict, n_jobs=n_jobs)
+
+    assert combined.keys() == combined_parallel.keys()
+    for structure_name, combined_label in combined.items():
+        assert np.array_equal(
+            sitk.GetArrayFromImage(combined_label),
+            sitk.GetArrayFromImage(combined_parallel[structure_name]),
+        )
+
+
+@pytest.mark.parametrize("n_jobs", [0, -2])
+def test_combine_labels_staple_invalid_n_jobs(n_jobs):
+
+    with pytest.raises(ValueError):
+        combine_labels_staple(make_test_labels((8, 8, 8)), n_jobs=n_jobs)
+
+
+def test_combine_labels_staple_unknown_cpu_count(monkeypatch):
+
+    monkeypatch.setattr("os.cpu_count", lambda: None)
+    label_list_dict = make_test_labels((8, 8, 8))
+
+    assert combine_labels_staple(label_list_dict, n_jobs=-1).keys() == {"A", "B"}
+
+
+@pytest.mark.parametrize("bins", [2, 16, 64, 300])
+def test_mutual_information_integer_bins(bins):
+
+    arr_a, arr_b = make_test_arrays((20, 20, 20))
+    arr_a, arr_b = arr_a.ravel(), arr_b.ravel()
+
+    mi = mutual_information(arr_a, arr_b, bins=bins)
+    mi_ref = reference_mutual_information(arr_a, arr_b, bins)
+
+    assert np.isclose(mi, mi_ref)
+
+    # Identical arrays share all information
+    assert mutual_information(arr_a, arr_a, bins=bins) > mi
+
+
+def test_mutual_information_bin_edges():
+
+    arr_a, arr_b = make_test_arrays((20, 20, 20))
+    arr_a, arr_b = arr_a.ravel(), arr_b.ravel()
+
+    edges = np.array([-500, -200, -50, 0, 10, 100, 500])
+
+    mi = mutual_information(arr_a, arr_b, bins=edges)
+    mi_ref = reference_mutual_information(arr_a, arr_b, edges)
+
+    assert np.isclose(mi, mi_ref)
+
+
+@pytest.mark.parametrize(
+    "arr_a",
+    [
+        np.array([-100, 100, 0, 5], dtype=np.int8),
+        np.array([-30000, 30000, 0, 5], dtype=np.int16),
+        np.array([0, 200, 100, 5], dtype=np.uint8),
+    ],
+)
+def test_mutual_information_integer_arrays(arr_a):
+
+    arr_b = np.array([1, 2, 3, 4], dtype=arr_a.dtype)
+
+    mi = mutual_information(arr_a, arr_b, bins=4)
+    mi_ref = reference_mutual_information(arr_a, arr_b, 4)
+
+    assert np.isclose(mi, mi_ref)